@@ -1,18 +1,37 @@
 import sys
+from collections import Counter, deque
 
 from crossword import *
 
 class CrosswordCreator():
 
+    # Font used by `save`, loaded on first use
+    _font = None
+
     def __init__(self, crossword):
         """
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+
+        # Bucket the vocabulary by length once, so every domain starts out
+        # node-consistent instead of holding the whole word list
+        words_by_length = {}
+        for word in self.crossword.words:
+            words_by_length.setdefault(len(word), set()).add(word)
         self.domains = {
-            var: self.crossword.words.copy()
+            var: words_by_length.get(var.length, set()).copy()
             for var in self.crossword.variables
         }
+        # The crossword graph never changes, keep plain lookups at hand
+        self._neighbors = {
+            var: frozenset(crossword.neighbors(var))
+            for var in crossword.variables
+        }
+        self._overlap = crossword.overlaps
+        self._degree = {
+            var: len(neighbors) for var, neighbors in self._neighbors.items()
+        }
 
     def letter_grid(self, assignment):
         """
@@ -23,11 +42,12 @@ class CrosswordCreator():
             for _ in range(self.crossword.height)
         ]
         for variable, word in assignment.items():
-            direction = variable.direction
-            for k in range(len(word)):
-                i = variable.i + (k if direction == Variable.DOWN else 0)
-                j = variable.j + (k if direction == Variable.ACROSS else 0)
-                letters[i][j] = word[k]
+            i, j = variable.i, variable.j
+            if variable.direction == Variable.ACROSS:
+                letters[i][j:j + len(word)] = word
+            else:
+                for k, letter in enumerate(word):
+                    letters[i + k][j] = letter
         return letters
 
     def print(self, assignment):
@@ -35,13 +55,11 @@ class CrosswordCreator():
         Print crossword assignment to the terminal.
         """
         letters = self.letter_grid(assignment)
-        for i in range(self.crossword.height):
-            for j in range(self.crossword.width):
-                if self.crossword.structure[i][j]:
-                    print(letters[i][j] or " ", end="")
-                else:
-                    print("█", end="")
-            print()
+        for row, structure_row in zip(letters, self.crossword.structure):
+            print("".join(
+                (letter or " ") if is_open else "█"
+                for letter, is_open in zip(row, structure_row)
+            ))
 
     def save(self, assignment, filename):
         """
@@ -60,9 +78,20 @@ class CrosswordCreator():
              self.crossword.height * cell_size),
             "black"
         )
-        font = ImageFont.truetype("crossword/assets/fonts/OpenSans-Regular.ttf", 80)
+        if CrosswordCreator._font is None:
+            CrosswordCreator._font = ImageFont.truetype(
+                "crossword/assets/fonts/OpenSans-Regular.ttf", 80
+            )
+        font = CrosswordCreator._font
         draw = ImageDraw.Draw(img)
 
+        # Every occurrence of a letter has the same metrics, measure it once
+        metrics = {}
+        for letter in {cell for row in letters for cell in row}:
+            if letter:
+                _, _, w, h = draw.textbbox((0, 0), letter, font=font)
+                metrics[letter] = (w, h)
+
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
 
@@ -75,7 +104,7 @@ class CrosswordCreator():
                 if self.crossword.structure[i][j]:
                     draw.rectangle(rect, fill="white")
                     if letters[i][j]:
-                        _, _, w, h = draw.textbbox((0, 0), letters[i][j], font=font)
+                        w, h = metrics[letters[i][j]]
                         draw.text(
                             (rect[0][0] + ((interior_size - w) / 2),
                              rect[0][1] + ((interior_size - h) / 2) - 10),
@@ -86,9 +115,9 @@ class CrosswordCreator():
 
     def solve(self):
         """
-        Enforce node and arc consistency, and then solve the CSP.
+        Enforce arc consistency, and then solve the CSP.
+        (Domains are already node-consistent, see `__init__`.)
         """
-        self.enforce_node_consistency()
         self.ac3()
         return self.backtrack(dict())
 
@@ -98,45 +127,78 @@ class CrosswordCreator():
         (Remove any values that are inconsistent with a variable's unary
          constraints; in this case, the length of the word.)
         """
-        all_nodes = self.domains.keys()
-        for node in all_nodes:
+        for node in self.domains:
             length_of_node = node.length
-            all_words = self.domains[node]
-            for word in all_words.copy():
-                if len(word) != length_of_node:
-                    self.domains[node].remove(word)
+            self.domains[node] = {
+                word for word in self.domains[node]
+                if len(word) == length_of_node
+            }
 
-    def revise(self, x, y):
+    def revise(self, x, y, buckets=None):
         """
         Make variable `x` arc consistent with variable `y`.
         To do so, remove values from `self.domains[x]` for which there is no
         possible corresponding value for `y` in `self.domains[y]`.
+        `buckets` is an index of the current domains from `_build_buckets`,
+        which is kept up to date; without it, `self.domains[y]` is indexed
+        on the spot.
 
         Return True if a revision was made to the domain of `x`; return
         False if no revision was made.
         """
 
-        is_revised = False
-        constraints = self.crossword.overlaps[(x, y)]
-        domain_1 = self.domains[x]
-        domain_2 = self.domains[y]
-        
-        for possible_value in domain_1.copy():
-            is_satisfied = False
-            for check in domain_2:
-                if possible_value == check:
-                    continue
-                if possible_value[constraints[0]] != check[constraints[1]]:
-                    continue
-                #if it succeeds to come so far, we say possible value in domain 1
-                #is arc-consistent with value x in domain2
-                is_satisfied = True
-                break
-
-            if not is_satisfied:
-                self.domains[x].remove(possible_value)
-                is_revised = True
-        return is_revised
+        constraints = self._overlap[(x, y)]
+        if buckets is None:
+            y_buckets = {}
+            for word in self.domains[y]:
+                y_buckets.setdefault(word[constraints[1]], set()).add(word)
+        else:
+            y_buckets = buckets[y][constraints[1]]
+        #words of different lengths can never be the same word
+        same_len = x.length == y.length
+
+        new_domain = set()
+        removed = []
+        for possible_value in self.domains[x]:
+            bucket = y_buckets.get(possible_value[constraints[0]])
+            #a word can not support itself, since both variables can't share it
+            if bucket and (not same_len or len(bucket) > 1
+                           or possible_value not in bucket):
+                new_domain.add(possible_value)
+            else:
+                removed.append(possible_value)
+
+        if not removed:
+            return False
+        self.domains[x] = new_domain
+        if buckets is None:
+            return True
+
+        # take the removed words out of x's own buckets
+        for position, position_buckets in buckets[x].items():
+            for word in removed:
+                bucket = position_buckets[word[position]]
+                bucket.discard(word)
+                if not bucket:
+                    del position_buckets[word[position]]
+        return True
+
+    def _build_buckets(self):
+        """
+        Return an index that maps every variable `y` and every position `j`
+        where another variable crosses it to the words in `self.domains[y]`,
+        grouped by their character at `j`.
+        """
+        buckets = {}
+        for y in self.domains:
+            buckets[y] = {}
+            for x in self._neighbors[y]:
+                j = self._overlap[(x, y)][1]
+                position_buckets = {}
+                for word in self.domains[y]:
+                    position_buckets.setdefault(word[j], set()).add(word)
+                buckets[y][j] = position_buckets
+        return buckets
 
     def ac3(self, arcs=None):
         """
@@ -147,16 +209,26 @@ class CrosswordCreator():
         Return True if arc consistency is enforced and no domains are empty;
         return False if one or more domains end up empty.
         """
+        buckets = self._build_buckets()
         if arcs is None:
-            arcs = [(var, neighbor) for var in self.domains.keys() for neighbor in self.crossword.neighbors(var) if neighbor != var]
-        while len(arcs) != 0:
-            x, y = arcs.pop(0)
-            if self.revise(x, y):
+            arcs = deque(
+                (var, neighbor) for var in self.domains.keys()
+                for neighbor in self._neighbors[var] if neighbor != var
+            )
+        else:
+            arcs = deque(arcs)
+        # an arc already waiting in the queue needs no second copy
+        queued = set(arcs)
+        while arcs:
+            x, y = arcs.popleft()
+            queued.discard((x, y))
+            if self.revise(x, y, buckets):
                 if len(self.domains[x]) == 0:
                     return False
-                for neighbor in self.crossword.neighbors(x):
-                    if neighbor != y:
+                for neighbor in self._neighbors[x]:
+                    if neighbor != y and (neighbor, x) not in queued:
                         arcs.append((neighbor, x))
+                        queued.add((neighbor, x))
         return True
 
             
@@ -166,24 +238,19 @@ class CrosswordCreator():
         Return True if `assignment` is complete (i.e., assigns a value to each
         crossword variable); return False otherwise.
         """
-        all_variables = self.domains.keys()
-        for i in all_variables:
-            if i in assignment.keys():
-                continue
-            return False
-        return True
+        return len(assignment) == len(self.domains)
 
     def consistent(self, assignment):
         """
         Return True if `assignment` is consistent (i.e., words fit in crossword
         puzzle without conflicting characters); return False otherwise.
         """
-        constraints = self.crossword.overlaps
+        constraints = self._overlap
         for var in assignment.keys():
             if var.length != len(assignment[var]):
                 return False
             if assignment[var] in self.domains[var]:
-                neighbors = [neighbor for neighbor in self.crossword.neighbors(var) if neighbor in assignment.keys()]
+                neighbors = [neighbor for neighbor in self._neighbors[var] if neighbor in assignment.keys()]
                 for neighbor in neighbors:
                     the_constraint = constraints[(var, neighbor)]
                     if the_constraint is None:
@@ -198,6 +265,20 @@ class CrosswordCreator():
                 return False
         return True
 
+    def _consistent_with(self, var, assignment):
+        """
+        Return True if the word assigned to `var` agrees with every already
+        assigned neighbor of `var`; return False otherwise.
+        """
+        var_word = assignment[var]
+        for neighbor in self._neighbors[var]:
+            if neighbor not in assignment:
+                continue
+            the_constraint = self._overlap[(var, neighbor)]
+            if var_word[the_constraint[0]] != assignment[neighbor][the_constraint[1]]:
+                return False
+        return True
+
     def order_domain_values(self, var, assignment):
         """
         Return a list of values in the domain of `var`, in order by
@@ -207,27 +288,27 @@ class CrosswordCreator():
         """
         if var in assignment:
             return False
-        the_neighbors = self.crossword.neighbors(var)
-        minimum_affect = []
-        possible_values = self.domains[var]
-        counts_dict = {}
-        neighboring_values = [value for neighbor in the_neighbors for value in self.domains[neighbor]]
-        for one_value in possible_values:
-            count = neighboring_values.count(one_value)
-            if count in counts_dict:
-                counts_dict[count].append(one_value)
-            else:
-                counts_dict[count] = [one_value]
-
-        sorted_counts = list(counts_dict.keys())
-        sorted_counts.sort()
-        for i in sorted_counts:
-            minimum_affect += counts_dict[i]
-        
-        return minimum_affect
 
+        # for every unassigned neighbor, how many of its words place each
+        # character on the overlap with `var`
+        histograms = []
+        for neighbor in self._neighbors[var]:
+            if neighbor in assignment:
+                continue
+            i, j = self._overlap[(var, neighbor)]
+            histogram = Counter(word[j] for word in self.domains[neighbor])
+            histograms.append((self.domains[neighbor], i, j, histogram))
 
+        def ruled_out(one_value):
+            count = 0
+            for neighbor_domain, i, j, histogram in histograms:
+                count += len(neighbor_domain) - histogram.get(one_value[i], 0)
+                #a neighbor can't take the very same word either
+                if one_value in neighbor_domain and one_value[i] == one_value[j]:
+                    count += 1
+            return count
 
+        return sorted(self.domains[var], key=ruled_out)
 
     def select_unassigned_variable(self, assignment):
         """
@@ -237,61 +318,86 @@ class CrosswordCreator():
         degree. If there is a tie, any of the tied variables are acceptable
         return values.
         """
-        candidates = []
-        min_remaining_values = float("inf")
-        for i in self.domains.keys():
-            if i not in assignment.keys():
-                values = self.domains[i]
-                if len(values) < min_remaining_values:
-                    candidates.clear()
-                    candidates.append(i)
-                if len(values) == min_remaining_values:
-                    candidates.append(i)
-        
-        if len(candidates) == 1:
-            return candidates[0]
-        highest_degree = -1
-        highest_degree_vertex = None
-        for i in candidates:
-            neighbors = self.crossword.neighbors(i)
-            if len(neighbors) > highest_degree:
-                highest_degree_vertex = i
-                highest_degree = len(neighbors)
-        return highest_degree_vertex
-
-
-
-    def backtrack(self, assignment):
+        unassigned = self.domains.keys() - assignment.keys()
+        return min(
+            unassigned,
+            key=lambda var: (len(self.domains[var]), -self._degree[var])
+        )
+
+    def _forward_check(self, var, assignment):
+        """
+        Remove from the domains of unassigned neighbors of `var` every word
+        that conflicts with the word just assigned to `var`.
+
+        Return a mapping from neighbors to the words removed from them, so
+        they can be given back with `_restore`; return None (leaving the
+        domains untouched) if some neighbor would be left with no words.
+        """
+        value = assignment[var]
+        removed = {}
+        # smallest domains first, so a wipeout is found with the least work
+        unassigned = sorted(
+            self._neighbors[var] - assignment.keys(),
+            key=lambda neighbor: len(self.domains[neighbor])
+        )
+        for neighbor in unassigned:
+            i, j = self._overlap[(var, neighbor)]
+            bad = {
+                word for word in self.domains[neighbor]
+                if word[j] != value[i] or word == value
+            }
+            if not bad:
+                continue
+            if len(bad) == len(self.domains[neighbor]):
+                self._restore(removed)
+                return None
+            self.domains[neighbor] -= bad
+            removed[neighbor] = bad
+        return removed
+
+    def _restore(self, removed):
+        """
+        Give back the words taken out of domains by `_forward_check`.
+        """
+        for neighbor, bad in removed.items():
+            self.domains[neighbor] |= bad
+
+    def backtrack(self, assignment, used=None):
         """
         Using Backtracking Search, take as input a partial assignment for the
         crossword and return a complete assignment if possible to do so.
 
         `assignment` is a mapping from variables (keys) to words (values).
+        `used` is the set of words in `assignment`, kept alongside it.
 
         If no assignment is possible, return None.
         """
-
-        if not self.consistent(assignment):
-            return None
+        if used is None:
+            used = set(assignment.values())
 
         if self.assignment_complete(assignment):
             return assignment
 
-
         possible_assignment = self.select_unassigned_variable(assignment)
         value_candidates = self.order_domain_values(possible_assignment, assignment)
         if not value_candidates:
             print("something is off.")
             return None
         for value in value_candidates:
-            if value in assignment.values():
+            if value in used:
                 continue
+            used.add(value)
             assignment[possible_assignment] = value
-            is_done = self.backtrack(assignment)
-            if is_done is None:
-                assignment.pop(possible_assignment)
-                continue
-            return is_done
+            #only the newly assigned variable can introduce a conflict
+            if self._consistent_with(possible_assignment, assignment):
+                removed = self._forward_check(possible_assignment, assignment)
+                if removed is not None:
+                    is_done = self.backtrack(assignment, used)
+                    if is_done is not None:
+                        return is_done
+                    self._restore(removed)
+            used.discard(value)
+            assignment.pop(possible_assignment)
         return None
 
 def main():